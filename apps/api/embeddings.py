@@ -0,0 +1,85 @@
+import shutil
+import threading
+from pathlib import Path
+
+import numpy as np
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from transformers import AutoTokenizer
+
+MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
+MAX_SEQ_LENGTH = 256  # same truncation as the SentenceTransformer config
+
+# Built once by `python embeddings.py`; the API only loads it
+ONNX_DIR = Path(__file__).resolve().parent / ".onnx" / "all-MiniLM-L6-v2"
+QUANTIZED_FILE = "model_quantized.onnx"
+
+
+def export_quantized(out_dir: Path = ONNX_DIR):
+    # build in a scratch dir and swap it in, so an interrupted export never
+    # leaves a partial model_quantized.onnx where the API would load it
+    tmp_dir = out_dir.with_name(out_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    model = ORTModelForFeatureExtraction.from_pretrained(MODEL_ID, export=True)
+    model.save_pretrained(tmp_dir)
+    AutoTokenizer.from_pretrained(MODEL_ID).save_pretrained(tmp_dir)
+
+    # dynamic INT8 quantization (VNNI dot products where the CPU has them)
+    quantizer = ORTQuantizer.from_pretrained(tmp_dir, file_name="model.onnx")
+    qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=tmp_dir, quantization_config=qconfig)
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    tmp_dir.rename(out_dir)
+
+
+class OnnxEmbedder:
+    """all-MiniLM-L6-v2 on ONNX Runtime; mean pooling + L2 norm like SentenceTransformer."""
+
+    def __init__(self, model_dir: Path = ONNX_DIR):
+        model_dir = Path(model_dir)
+        if not (model_dir / QUANTIZED_FILE).exists():
+            raise RuntimeError(
+                f"ONNX embedding model not found in {model_dir}. "
+                "Run `python embeddings.py` once to export it."
+            )
+
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        # fast tokenizers mutate padding/truncation state per call and raise
+        # "Already borrowed" when shared across threads; ORT sessions are safe
+        self._tokenizer_lock = threading.Lock()
+        self.model = ORTModelForFeatureExtraction.from_pretrained(
+            model_dir,
+            file_name=QUANTIZED_FILE,
+            provider="CPUExecutionProvider",
+        )
+
+    def encode(self, texts: list[str], batch_size: int = 64) -> np.ndarray:
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            with self._tokenizer_lock:
+                enc = self.tokenizer(
+                    texts[start:start + batch_size],
+                    padding=True,
+                    truncation=True,
+                    max_length=MAX_SEQ_LENGTH,
+                    return_tensors="np",
+                )
+            hidden = self.model(**enc).last_hidden_state
+
+            mask = enc["attention_mask"][..., None].astype(np.float32)
+            summed = (hidden * mask).sum(axis=1)
+            batches.append(summed / np.clip(mask.sum(axis=1), 1e-9, None))
+
+        vecs = np.concatenate(batches).astype(np.float32, copy=False)
+        vecs /= np.clip(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12, None)
+        return vecs
+
+
+def main():
+    export_quantized()
+    print(f"Exported quantized model to {ONNX_DIR}")
+
+if __name__ == "__main__":
+    main()
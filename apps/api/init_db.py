@@ -1,8 +1,49 @@
+from sqlalchemy import text
+
 from db import engine
-from models import Base, DrugLabel, DrugLabelChunk
+from models import Base, DrugLabel, DrugLabelChunk, EMBEDDING_DIM
+
+# Indexes replaced by ix_chunks_label_section_idx, or no longer used
+OBSOLETE_INDEXES = [
+    "ix_drug_label_chunks_label_id",
+    "ix_drug_label_chunks_section",
+    "ix_drug_label_chunks_embedding_hnsw",
+]
+
+
+def upgrade_chunks_table(conn):
+    # create_all skips tables that already exist, so bring older
+    # drug_label_chunks tables up to the current model in place
+    conn.execute(text(
+        "ALTER TABLE drug_label_chunks ADD COLUMN IF NOT EXISTS tsv tsvector "
+        "GENERATED ALWAYS AS (to_tsvector('english', text)) STORED"
+    ))
+
+    # embeddings went JSON text -> vector -> halfvec; only rewrite when needed
+    current = conn.execute(text(
+        "SELECT format_type(atttypid, atttypmod) FROM pg_attribute "
+        "WHERE attrelid = 'drug_label_chunks'::regclass AND attname = 'embedding'"
+    )).scalar()
+    target = f"halfvec({EMBEDDING_DIM})"
+    if current != target:
+        conn.execute(text(
+            f"ALTER TABLE drug_label_chunks ALTER COLUMN embedding "
+            f"TYPE {target} USING embedding::{target}"
+        ))
+
+    for name in OBSOLETE_INDEXES:
+        conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    for index in DrugLabelChunk.__table__.indexes:
+        index.create(bind=conn, checkfirst=True)
+
 
 def main():
+    # pgvector must be enabled before the halfvec embedding column is created
+    with engine.begin() as conn:
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
     Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        upgrade_chunks_table(conn)
     print("Tables created successfully")
 
 if __name__ == "__main__":
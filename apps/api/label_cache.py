@@ -0,0 +1,39 @@
+import threading
+from collections import OrderedDict
+
+
+class LabelCache:
+    """Thread-safe LRU of per-label data; callers evict a label when its chunks change."""
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        # bumped on every pop, so a fill that read the DB before an
+        # invalidation can tell its value is stale and skip storing it
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def generation(self, label_id: int) -> int:
+        with self._lock:
+            return self._generations.get(label_id, 0)
+
+    def get(self, label_id: int):
+        with self._lock:
+            value = self._data.get(label_id)
+            if value is not None:
+                self._data.move_to_end(label_id)
+            return value
+
+    def put(self, label_id: int, value, generation: int | None = None):
+        with self._lock:
+            if generation is not None and generation != self._generations.get(label_id, 0):
+                return
+            self._data[label_id] = value
+            self._data.move_to_end(label_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, label_id: int):
+        with self._lock:
+            self._data.pop(label_id, None)
+            self._generations[label_id] = self._generations.get(label_id, 0) + 1
@@ -1,21 +1,34 @@
 ﻿from fastapi import FastAPI, Query, HTTPException, Depends
 import httpx
-from sqlalchemy import text
+from sqlalchemy import func, insert, text
 from sqlalchemy.orm import Session
 from datetime import datetime
 
 from db import engine, SessionLocal
-from models import DrugLabel, DrugLabelChunk
+from models import DrugLabel, DrugLabelChunk, EMBEDDING_DIM
+from embeddings import OnnxEmbedder
+from label_cache import LabelCache
+import semantic_cache
 from fastapi.middleware.cors import CORSMiddleware
+# Deprecated in newer FastAPI, which serializes through Pydantic instead;
+# requirements.txt pins a release where it is still the fast path
+from fastapi.responses import ORJSONResponse
 
 
 import os
 import re
-import json
 import math
-from sentence_transformers import SentenceTransformer
-
-app = FastAPI(title="PharmaGuard API", version="0.1.0")
+import string
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_right
+from collections import namedtuple
+from functools import lru_cache
+import ahocorasick
+import numpy as np
+import orjson
+
+app = FastAPI(title="PharmaGuard API", version="0.1.0", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -25,7 +38,36 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-embedder = SentenceTransformer("all-MiniLM-L6-v2")
+
+@app.on_event("startup")
+async def open_http_client():
+    # one pooled client so outbound openFDA/RxNav calls reuse TLS connections
+    app.state.http = httpx.AsyncClient(
+        timeout=15.0,
+        http2=True,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    )
+
+
+@app.on_event("startup")
+async def configure_executor():
+    # asyncio.to_thread workers for blocking DB + embedding work
+    workers = min(32, (os.cpu_count() or 1) * 2)
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=workers))
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    await app.state.http.aclose()
+
+
+embedder = OnnxEmbedder()
+EMBED_BATCH_SIZE = 64
+
+LabelChunk = namedtuple("LabelChunk", ["id", "section", "chunk_index", "text"])
+
+# label_id -> (float32 embedding matrix, chunk metadata)
+_label_matrix_cache = LabelCache(maxsize=256)
 
 
 def get_db():
@@ -36,12 +78,17 @@ def get_db():
         db.close()
 
 
+_WS_RE = re.compile(r"\s+")
+_SENT_RE = re.compile(r'(?<=[.!?])\s+')
+_TOKEN_CLEAN_RE = re.compile(r"[^a-z0-9\s\-]")
+
+
 def chunk_text(text: str, max_chars: int = 1000, overlap_sentences: int = 1):
     if not text:
         return []
 
-    text = re.sub(r"\s+", " ", text).strip()
-    sentences = re.split(r'(?<=[.!?])\s+', text)
+    text = _WS_RE.sub(" ", text).strip()
+    sentences = _SENT_RE.split(text)
 
     chunks = []
     cur = []
@@ -62,10 +109,10 @@ def chunk_text(text: str, max_chars: int = 1000, overlap_sentences: int = 1):
 
             # overlap last N sentences to preserve context
             cur = cur[-overlap_sentences:] if overlap_sentences > 0 else []
-            cur_len = len(" ".join(cur))
+            cur_len = sum(len(x) for x in cur) + max(0, len(cur) - 1)
 
+            cur_len += len(s) + (1 if cur else 0)
             cur.append(s)
-            cur_len = len(" ".join(cur))
 
     if cur:
         chunks.append(" ".join(cur).strip())
@@ -75,75 +122,168 @@ def chunk_text(text: str, max_chars: int = 1000, overlap_sentences: int = 1):
 
 def tokenize(q: str):
     q = q.lower()
-    q = re.sub(r"[^a-z0-9\s\-]", " ", q)
+    q = _TOKEN_CLEAN_RE.sub(" ", q)
     return [t for t in q.split() if len(t) >= 3]
 
 
-def embed_texts(texts: list[str]) -> list[list[float]]:
-    vectors = embedder.encode(texts, normalize_embeddings=True)
-    return [v.tolist() for v in vectors]
+def embed_texts(texts: list[str]) -> np.ndarray:
+    if not texts:
+        return np.empty((0, EMBEDDING_DIM), dtype=np.float32)
+
+    # Encode longest-first so each batch only pads to its own max length,
+    # then scatter the rows back into input order
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i].split()), reverse=True)
+    vectors = embedder.encode([texts[i] for i in order], batch_size=EMBED_BATCH_SIZE)
 
+    # packed float32 rows; callers slice/stack these without boxing to Python floats
+    out = np.empty((len(texts), vectors.shape[1]), dtype=np.float32)
+    out[order] = vectors
+    return out
 
-def dot(a, b):
-    return sum(x*y for x, y in zip(a, b))  # normalized vectors
+
+def top_k(scores: np.ndarray, limit: int) -> np.ndarray:
+    # indices of the `limit` highest scores, best first
+    if limit < len(scores):
+        idx = np.argpartition(-scores, limit)[:limit]
+    else:
+        idx = np.arange(len(scores))
+    return idx[np.argsort(-scores[idx], kind="stable")]
 
 def retrieve_chunks(db: Session, label_id: int, question: str, limit: int = 6):
     tokens = tokenize(question)
     if not tokens:
         return []
 
-    # simple scoring: count how many tokens appear in chunk text
+    terms = [t.strip("-") for t in tokens]
+    terms = [t for t in terms if t]
+    if not terms:
+        return []
+
+    # any term may match (OR); Postgres ranks with the GIN-indexed tsvector
+    query = func.to_tsquery("english", " | ".join(terms))
+    return (
+        db.query(
+            DrugLabelChunk.id,
+            DrugLabelChunk.section,
+            DrugLabelChunk.chunk_index,
+            DrugLabelChunk.text,
+        )
+        .filter(DrugLabelChunk.label_id == label_id)
+        .filter(DrugLabelChunk.tsv.op("@@")(query))
+        .order_by(func.ts_rank_cd(DrugLabelChunk.tsv, query).desc())
+        .limit(limit)
+        .all()
+    )
+
+def halfvec_to_numpy(value) -> np.ndarray:
+    # pgvector 0.3-0.4 returns a HalfVector for halfvec columns, 0.5+ a list[float]
+    if hasattr(value, "to_list"):
+        value = value.to_list()
+    return np.asarray(value, dtype=np.float32)
+
+
+def load_label_matrix(db: Session, label_id: int):
+    cached = _label_matrix_cache.get(label_id)
+    if cached is not None:
+        return cached
+
+    # read before the SELECT; put() drops the entry if the label was invalidated meanwhile
+    generation = _label_matrix_cache.generation(label_id)
     rows = (
-        db.query(DrugLabelChunk)
+        db.query(
+            DrugLabelChunk.id,
+            DrugLabelChunk.section,
+            DrugLabelChunk.chunk_index,
+            DrugLabelChunk.text,
+            DrugLabelChunk.embedding,
+        )
         .filter(DrugLabelChunk.label_id == label_id)
+        .filter(DrugLabelChunk.embedding.isnot(None))
+        .order_by(DrugLabelChunk.id.asc())
         .all()
     )
 
-    scored = []
-    for r in rows:
-        text_lower = (r.text or "").lower()
-        score = sum(1 for t in tokens if t in text_lower)
-        if score > 0:
-            scored.append((score, r))
+    chunks = [LabelChunk(r.id, r.section, r.chunk_index, r.text) for r in rows]
+    if rows:
+        # widen halfvec rows once here so scoring stays float32 BLAS
+        M = np.stack([halfvec_to_numpy(r.embedding) for r in rows])
+    else:
+        M = np.empty((0, EMBEDDING_DIM), dtype=np.float32)
 
-    scored.sort(key=lambda x: x[0], reverse=True)
-    return [r for _, r in scored[:limit]]
+    entry = (M, chunks)
+    _label_matrix_cache.put(label_id, entry, generation)
+    return entry
 
-def retrieve_semantic(db: Session, label_id: int, question: str, limit: int = 6):
-    q = embed_texts([question])[0]
-    rows = db.query(DrugLabelChunk).filter(DrugLabelChunk.label_id == label_id).all()
 
-    scored = []
-    for r in rows:
-        if not r.embedding:
-            continue
-        v = json.loads(r.embedding)
-        scored.append((dot(q, v), r))
+def invalidate_label_caches(label_id: int):
+    _label_matrix_cache.pop(label_id)
+    semantic_cache.invalidate(label_id)
+
+
+def retrieve_semantic(
+    db: Session, label_id: int, question: str, limit: int = 6, q_vec: np.ndarray | None = None
+):
+    M, chunks = load_label_matrix(db, label_id)
+    if not chunks:
+        return []
+
+    if q_vec is None:
+        q_vec = embed_texts([question])[0]
+
+    return top_k_against(M, chunks, q_vec[None, :], [limit])[0]
 
-    scored.sort(key=lambda x: x[0], reverse=True)
-    return [r for _, r in scored[:limit]]
+
+def top_k_against(M: np.ndarray, chunks: list, Q: np.ndarray, limits: list[int]):
+    # one (N, 384) @ (384, len(Q)) product, then the best chunks per query
+    S = M @ Q.T  # normalized vectors -> cosine similarity
+    return [[chunks[i] for i in top_k(S[:, j], limit)] for j, limit in enumerate(limits)]
+
+
+# A-Z -> a-z only, so offsets in the lowered text line up with the original
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+@lru_cache(maxsize=64)
+def keyword_automaton(keywords: tuple[str, ...]):
+    automaton = ahocorasick.Automaton()
+    for k in keywords:
+        automaton.add_word(k, k)
+    automaton.make_automaton()
+    return automaton
 
 
 def best_sentence(text: str, keywords: list[str], max_len: int = 240) -> str:
     if not text:
         return ""
 
-    # Split into sentence-ish chunks
-    sentences = re.split(r'(?<=[.!?])\s+', text.strip())
-
-    # Pick the first sentence that contains a keyword
-    for s in sentences:
-        s_low = s.lower()
-        if any(k in s_low for k in keywords) and len(s.strip()) > 20:
-            return s.strip()[:max_len]
+    # Sentence-ish (start, end) spans, same split as chunk_text
+    text = text.strip()
+    starts, ends = [0], []
+    for m in _SENT_RE.finditer(text):
+        ends.append(m.start())
+        starts.append(m.end())
+    ends.append(len(text))
+
+    # Pick the first sentence that contains a keyword (one pass over the text)
+    if keywords:
+        checked = -1
+        for end, _ in keyword_automaton(tuple(keywords)).iter(text.translate(_ASCII_LOWER)):
+            i = bisect_right(starts, end) - 1
+            if i <= checked:
+                continue
+            checked = i
+            s = text[starts[i]:ends[i]].strip()
+            if len(s) > 20:
+                return s[:max_len]
 
     # Fallback: first "reasonable" sentence
-    for s in sentences:
-        if len(s.strip()) > 40:
-            return s.strip()[:max_len]
+    for start, end in zip(starts, ends):
+        s = text[start:end].strip()
+        if len(s) > 40:
+            return s[:max_len]
 
     # Final fallback
-    return text.strip()[:max_len]
+    return text[:max_len]
 
 
 @app.get("/health")
@@ -168,10 +308,9 @@ async def rxnorm_normalize(name: str = Query(min_length=1, max_length=200)):
     url = "https://rxnav.nlm.nih.gov/REST/approximateTerm.json"
     params = {"term": name, "maxEntries": 5}
 
-    async with httpx.AsyncClient(timeout=10.0) as client:
-        resp = await client.get(url, params=params)
-        resp.raise_for_status()
-        data = resp.json()
+    resp = await app.state.http.get(url, params=params, timeout=10.0)
+    resp.raise_for_status()
+    data = orjson.loads(resp.content)
 
     candidates = data.get("approximateGroup", {}).get("candidate", [])
     results = [
@@ -190,15 +329,14 @@ async def fda_label(drug: str = Query(min_length=1, max_length=200)):
         "limit": 1
     }
 
-    async with httpx.AsyncClient(timeout=15.0) as client:
-        resp = await client.get(url, params=params)
+    resp = await app.state.http.get(url, params=params)
 
     if resp.status_code == 404:
         raise HTTPException(status_code=404, detail="No FDA label found for this drug name.")
     if resp.status_code != 200:
         raise HTTPException(status_code=resp.status_code, detail="openFDA request failed.")
 
-    data = resp.json()
+    data = orjson.loads(resp.content)
     results = data.get("results", [])
     if not results:
         raise HTTPException(status_code=404, detail="No FDA label found for this drug name.")
@@ -242,15 +380,14 @@ async def ingest_fda_label(
         "limit": 1
     }
 
-    async with httpx.AsyncClient(timeout=15.0) as client:
-        resp = await client.get(url, params=params)
+    resp = await app.state.http.get(url, params=params)
 
     if resp.status_code == 404:
         raise HTTPException(status_code=404, detail="No FDA label found for this drug name.")
     if resp.status_code != 200:
         raise HTTPException(status_code=resp.status_code, detail="openFDA request failed.")
 
-    data = resp.json()
+    data = orjson.loads(resp.content)
     results = data.get("results", [])
     if not results:
         raise HTTPException(status_code=404, detail="No FDA label found for this drug name.")
@@ -275,6 +412,20 @@ async def ingest_fda_label(
         "dosage_and_administration": get_first("dosage_and_administration"),
     }
 
+    # DB writes + chunk embedding block, so keep them off the event loop
+    return await asyncio.to_thread(_store_label, db, drug, label, sections)
+
+
+def _store_label(db: Session, drug: str, label: dict, sections: dict):
+    # Chunk every section and embed them in one batch before touching the DB,
+    # so the chunks are inserted with their embeddings (no re-query/UPDATE)
+    chunks = [
+        (section_name, idx, chunk)
+        for section_name, section_text in sections.items()
+        for idx, chunk in enumerate(chunk_text(section_text))
+    ]
+    vecs = embed_texts([chunk for _, _, chunk in chunks])
+
     row = DrugLabel(
         input_name=drug,
         set_id=label.get("set_id"),
@@ -289,36 +440,31 @@ async def ingest_fda_label(
     )
 
     db.add(row)
-    db.commit()
-    db.refresh(row)
-
-    # Store chunks
-    total_chunks = 0
-    for section_name, section_text in sections.items():
-        for idx, chunk in enumerate(chunk_text(section_text)):
-            db.add(DrugLabelChunk(
-                label_id=row.id,
-                section=section_name,
-                chunk_index=idx,
-                text=chunk
-            ))
-            total_chunks += 1
+    db.flush()  # assigns row.id
+    label_id, set_id = row.id, row.set_id
 
-    db.commit()
+    # Store chunks in one bulk INSERT (executemany) instead of an ORM object per row
+    if chunks:
+        db.execute(insert(DrugLabelChunk), [
+            {
+                "label_id": label_id,
+                "section": section_name,
+                "chunk_index": idx,
+                "text": chunk,
+                "embedding": v,
+            }
+            for (section_name, idx, chunk), v in zip(chunks, vecs)
+        ])
 
-    # Auto-embed chunks for this label
-    rows = db.query(DrugLabelChunk).filter(DrugLabelChunk.label_id == row.id).all()
-    vecs = embed_texts([r.text for r in rows])
-    for r, v in zip(rows, vecs):
-        r.embedding = json.dumps(v)
     db.commit()
+    invalidate_label_caches(label_id)
 
     return {
         "status": "stored",
-        "id": row.id,
+        "id": label_id,
         "input": drug,
-        "set_id": row.set_id,
-        "chunks_stored": total_chunks
+        "set_id": set_id,
+        "chunks_stored": len(chunks)
     }
 
 
@@ -388,16 +534,20 @@ def get_chunk(chunk_id: int, db: Session = Depends(get_db)):
 
 @app.post("/embed/label")
 def embed_label(label_id: int, db: Session = Depends(get_db)):
-    rows = db.query(DrugLabelChunk).filter(DrugLabelChunk.label_id == label_id).all()
-    to_embed = [r for r in rows if not r.embedding]
+    to_embed = (
+        db.query(DrugLabelChunk)
+        .filter(DrugLabelChunk.label_id == label_id, DrugLabelChunk.embedding.is_(None))
+        .all()
+    )
     if not to_embed:
         return {"status": "ok", "embedded": 0}
 
     vecs = embed_texts([r.text for r in to_embed])
     for r, v in zip(to_embed, vecs):
-        r.embedding = json.dumps(v)
+        r.embedding = v
 
     db.commit()
+    invalidate_label_caches(label_id)
     return {"status": "ok", "embedded": len(to_embed)}
 
 @app.get("/db-tables")
@@ -412,6 +562,10 @@ async def chat(
     question: str,
     db: Session = Depends(get_db),
 ):
+    return await asyncio.to_thread(_chat_sync, label_id, question, db)
+
+
+def _chat_sync(label_id: int, question: str, db: Session):
     q = question.lower()
 
     keywords = []
@@ -427,8 +581,14 @@ async def chat(
     if not keywords:
         keywords = ["warning", "interaction", "risk"]
 
+    # Paraphrases of an already-answered question (same label + keywords) reuse the answer
+    q_vec = embed_texts([question])[0]
+    cached = semantic_cache.lookup(label_id, keywords, q_vec)
+    if cached is not None:
+        return cached
+
     # Prefer semantic if embeddings exist, fallback to keyword
-    sem = retrieve_semantic(db, label_id, question, limit=6)
+    sem = retrieve_semantic(db, label_id, question, limit=6, q_vec=q_vec)
     if sem:
         matched = sem
     else:
@@ -458,7 +618,7 @@ async def chat(
             "preview": c.text[:200] + ("..." if len(c.text) > 200 else ""),
         })
 
-    return {
+    response = {
         "answer": answer_lines,
         "safety_note": "Not medical advice. Confirm with a pharmacist/clinician.",
         "citations": [
@@ -471,6 +631,17 @@ async def chat(
         ],
         "evidence": evidence,
     }
+    semantic_cache.store(label_id, keywords, q_vec, question, response)
+    return response
+
+def _latest_label_id(db: Session, drug: str):
+    row = (
+        db.query(DrugLabel.id)
+        .filter(DrugLabel.input_name.ilike(f"%{drug}%"))
+        .order_by(DrugLabel.created_at.desc())
+        .first()
+    )
+    return row.id if row else None
 
 @app.post("/chat-by-drug")
 async def chat_by_drug(
@@ -479,20 +650,15 @@ async def chat_by_drug(
     db: Session = Depends(get_db),
 ):
     # 1) Find most recent label for this drug (user might type brand/generic variants)
-    existing = (
-        db.query(DrugLabel)
-        .filter(DrugLabel.input_name.ilike(f"%{drug}%"))
-        .order_by(DrugLabel.created_at.desc())
-        .first()
-    )
+    existing_id = await asyncio.to_thread(_latest_label_id, db, drug)
 
     # 2) If not found, auto-ingest
-    if not existing:
+    if existing_id is None:
         # reuse your ingest logic directly (call function or inline minimal)
         stored = await ingest_fda_label(drug=drug, db=db)  # calls your POST /ingest logic
         label_id = stored["id"]
     else:
-        label_id = existing.id
+        label_id = existing_id
 
     # 3) Run your existing chat on that label_id
     result = await chat(label_id=label_id, question=question, db=db)
@@ -524,11 +690,18 @@ def compare(drug_a: str, drug_b: str, db: Session = Depends(get_db)):
             detail="Both drugs must be ingested first. Use POST /ingest/fda-label for each drug."
         )
 
-    # 2) Ensure embeddings exist (basic check)
-    a_chunks = db.query(DrugLabelChunk).filter(DrugLabelChunk.label_id == a.id).all()
-    b_chunks = db.query(DrugLabelChunk).filter(DrugLabelChunk.label_id == b.id).all()
+    # 2) Ensure embeddings exist (basic check) -- one EXISTS probe, served by
+    # the partial "embedding IS NULL" index, instead of loading every chunk
+    missing_embeddings = db.query(
+        db.query(DrugLabelChunk.id)
+        .filter(
+            DrugLabelChunk.label_id.in_([a.id, b.id]),
+            DrugLabelChunk.embedding.is_(None),
+        )
+        .exists()
+    ).scalar()
 
-    if any(c.embedding is None for c in a_chunks) or any(c.embedding is None for c in b_chunks):
+    if missing_embeddings:
         return {
             "status": "needs_embeddings",
             "message": "Run POST /embed/label for both label_id values first.",
@@ -540,8 +713,15 @@ def compare(drug_a: str, drug_b: str, db: Session = Depends(get_db)):
     q2 = f"Does the label mention interactions with {drug_a}?"
     q3 = "drug interactions anticoagulants aspirin NSAIDs blood thinners"
 
-    a_top = retrieve_semantic(db, a.id, q1, limit=4) + retrieve_semantic(db, a.id, q3, limit=2)
-    b_top = retrieve_semantic(db, b.id, q2, limit=4) + retrieve_semantic(db, b.id, q3, limit=2)
+    # embed all three questions at once, score each label's matrix once
+    Q = embed_texts([q1, q2, q3])
+    M_a, chunks_a = load_label_matrix(db, a.id)
+    M_b, chunks_b = load_label_matrix(db, b.id)
+
+    a_q1, a_q3 = top_k_against(M_a, chunks_a, Q[[0, 2]], [4, 2])
+    b_q2, b_q3 = top_k_against(M_b, chunks_b, Q[[1, 2]], [4, 2])
+    a_top = a_q1 + a_q3
+    b_top = b_q2 + b_q3
 
     def pack(rows):
         out = []
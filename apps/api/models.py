@@ -1,10 +1,16 @@
 from datetime import datetime
 
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey
-from sqlalchemy.orm import declarative_base
+from pgvector.sqlalchemy import HALFVEC
+from sqlalchemy import Column, Computed, Integer, String, Text, DateTime, ForeignKey, Index
+from sqlalchemy import text as sql_text
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import declarative_base, deferred
 
 Base = declarative_base()
 
+# all-MiniLM-L6-v2 output size
+EMBEDDING_DIM = 384
+
 
 class DrugLabel(Base):
     __tablename__ = "drug_labels"
@@ -35,14 +41,26 @@ class DrugLabelChunk(Base):
 
     id = Column(Integer, primary_key=True, index=True)
 
-    label_id = Column(Integer, ForeignKey("drug_labels.id"), nullable=False, index=True)
+    label_id = Column(Integer, ForeignKey("drug_labels.id"), nullable=False)
 
-    section = Column(String(100), nullable=False, index=True)
+    section = Column(String(100), nullable=False)
     chunk_index = Column(Integer, nullable=False)
 
     text = Column(Text, nullable=False)
 
-    # We'll store embeddings later (pgvector). For now, keep it as text.
-    embedding = Column(Text, nullable=True)
+    # Full-text search vector, kept in sync with `text` by Postgres.
+    # Deferred so loading chunks doesn't pull it over the wire.
+    tsv = deferred(Column(TSVECTOR, Computed("to_tsvector('english', text)", persisted=True)))
+
+    # Normalized sentence embedding, stored half precision (pgvector halfvec)
+    embedding = Column(HALFVEC(EMBEDDING_DIM), nullable=True)
 
     created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # /chunks filters on label_id and orders by (section, chunk_index)
+        Index("ix_chunks_label_section_idx", "label_id", "section", "chunk_index"),
+        # /embed/label only looks for chunks still missing an embedding
+        Index("ix_chunks_missing_embedding", "label_id", postgresql_where=sql_text("embedding IS NULL")),
+        Index("ix_drug_label_chunks_tsv", "tsv", postgresql_using="gin"),
+    )
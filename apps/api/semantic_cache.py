@@ -0,0 +1,118 @@
+import hashlib
+import time
+import uuid
+
+import numpy as np
+import orjson
+import redis
+
+REDIS_URL = "redis://localhost:6379/0"
+
+# Max cosine distance between two questions for a cached answer to be reused
+DEFAULT_THRESHOLD = 0.08
+ENTRY_TTL_SECONDS = 24 * 60 * 60
+# Every lookup scores all entries in its index, so keep only the newest N
+MAX_ENTRIES_PER_INDEX = 64
+
+client = redis.Redis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+
+def _keyword_hash(keywords) -> str:
+    return hashlib.sha1("|".join(keywords).encode()).hexdigest()[:16]
+
+
+def _index_key(label_id: int, keywords) -> str:
+    # entry keys for one label + keyword set, scored by created_ts. Answers are
+    # built from both the retrieved chunks and the keywords, so neither may cross over.
+    return f"cache:{label_id}:{_keyword_hash(keywords)}"
+
+
+def _label_indexes_key(label_id: int) -> str:
+    # every index key created for a label, so invalidate() can find them
+    return f"cache:{label_id}:indexes"
+
+
+def _entry_key(index_key: str, entry_id: str) -> str:
+    return f"{index_key}:{entry_id}"
+
+
+def lookup(label_id: int, keywords, q_vec, thresh: float = DEFAULT_THRESHOLD):
+    """Return the cached response for the nearest question on this label, or None."""
+    index_key = _index_key(label_id, keywords)
+    try:
+        keys = client.zrange(index_key, 0, -1)
+        if not keys:
+            return None
+
+        pipe = client.pipeline(transaction=False)
+        for k in keys:
+            pipe.hget(k, "vector")
+        blobs = pipe.execute()
+
+        expired = [k for k, b in zip(keys, blobs) if b is None]
+        if expired:
+            client.zrem(index_key, *expired)
+
+        live = [(k, b) for k, b in zip(keys, blobs) if b is not None]
+        if not live:
+            return None
+
+        M = np.frombuffer(b"".join(b for _, b in live), dtype=np.float32).reshape(len(live), -1)
+        scores = M @ np.asarray(q_vec, dtype=np.float32)  # normalized vectors
+        best = int(np.argmax(scores))
+        if 1.0 - float(scores[best]) > thresh:
+            return None
+
+        raw = client.hget(live[best][0], "response_json")
+    except redis.RedisError:
+        # cache is best-effort; fall through to the normal pipeline
+        return None
+
+    if raw is None:
+        return None
+    return orjson.loads(raw)
+
+
+def store(label_id: int, keywords, q_vec, prompt: str, response: dict, ttl: int = ENTRY_TTL_SECONDS):
+    index_key = _index_key(label_id, keywords)
+    indexes_key = _label_indexes_key(label_id)
+    key = _entry_key(index_key, uuid.uuid4().hex)
+    now = time.time()
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.hset(key, mapping={
+            "prompt": prompt,
+            "response_json": orjson.dumps(response),
+            "vector": np.asarray(q_vec, dtype=np.float32).tobytes(),
+            "created_ts": now,
+        })
+        pipe.expire(key, ttl)
+        pipe.zadd(index_key, {key: now})
+        pipe.zremrangebyscore(index_key, "-inf", now - ttl)
+        pipe.expire(index_key, ttl)
+        pipe.sadd(indexes_key, index_key)
+        pipe.expire(indexes_key, ttl)
+        # everything older than the newest MAX_ENTRIES_PER_INDEX
+        pipe.zrange(index_key, 0, -(MAX_ENTRIES_PER_INDEX + 1))
+        evicted = pipe.execute()[-1]
+
+        if evicted:
+            pipe = client.pipeline(transaction=False)
+            pipe.zrem(index_key, *evicted)
+            pipe.delete(*evicted)
+            pipe.execute()
+    except redis.RedisError:
+        pass
+
+
+def invalidate(label_id: int):
+    indexes_key = _label_indexes_key(label_id)
+    try:
+        index_keys = list(client.smembers(indexes_key))
+        pipe = client.pipeline(transaction=False)
+        for index_key in index_keys:
+            pipe.zrange(index_key, 0, -1)
+        entry_keys = [k for members in pipe.execute() for k in members]
+        client.delete(indexes_key, *index_keys, *entry_keys)
+    except redis.RedisError:
+        pass